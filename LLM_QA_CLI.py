@@ -1,15 +1,12 @@
+import argparse
+import asyncio
 import json
-import requests
-import re
-import time
-
-# --- Configuration ---
-# NOTE: In a real-world scenario, replace this empty string with your actual API key
-# The Canvas environment provides this key during execution, but for local use, you would set it here.
-API_KEY = ""
-MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key={API_KEY}"
-MAX_RETRIES = 5
+
+import gemini_client
+
+# Translation table built once at import: deletes every ASCII character that
+# is not a letter, digit, whitespace or underscore (the ASCII part of [^\w\s]).
+_DEL = dict.fromkeys(i for i in range(128) if not (chr(i).isalnum() or chr(i).isspace() or chr(i) == '_'))
 
 def preprocess_question(question: str) -> str:
     """
@@ -18,73 +15,68 @@ def preprocess_question(question: str) -> str:
     - Removes punctuation (except for spaces)
     - Tokenization (implicitly by splitting on space, though not fully standard tokenization)
     """
-    # 1. Lowercasing
-    text = question.lower()
-    # 2. Punctuation removal (keeping only letters, numbers, and spaces)
-    text = re.sub(r'[^\w\s]', '', text)
+    # 1. Punctuation removal + 2. Lowercasing, both single C-level passes
     # 3. Simple tokenization by splitting and joining (removes extra spaces)
-    tokens = text.split()
-    processed_text = ' '.join(tokens)
-    return processed_text
+    return ' '.join(question.translate(_DEL).lower().split())
+
+# Maximum number of questions in flight at once in --batch mode
+BATCH_CONCURRENCY = 10
+
+def print_sources(sources: list):
+    """Prints the grounding sources used for an answer, if any."""
+    if sources:
+        print("\n[Sources Used]:")
+        for i, source in enumerate(sources):
+            print(f"  {i+1}. {source['title']} ({source['uri']})")
 
-def get_llm_answer(prompt: str) -> dict:
+async def run_batch(questions: list) -> list:
     """
-    Sends the prompt to the Gemini API with Google Search Grounding.
-    Implements exponential backoff for robustness.
+    Sends all questions to the LLM concurrently (at most BATCH_CONCURRENCY at a time),
+    so their network latency overlaps. Returns the responses in question order.
     """
-    headers = {'Content-Type': 'application/json'}
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        # Use Google Search for up-to-date and factual grounding
-        "tools": [{"google_search": {}}],
-        "systemInstruction": {"parts": [{"text": "You are a helpful and expert Question-Answering system. Provide a concise and accurate answer based on the query and use Google Search grounding when necessary."}]},
-    }
-
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-            response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-            result = response.json()
-            
-            # Check for content and parts
-            candidate = result.get('candidates', [None])[0]
-            if not candidate or not candidate.get('content') or not candidate['content'].get('parts'):
-                return {"text": "API response was empty or malformed.", "sources": []}
-
-            text = candidate['content']['parts'][0]['text']
-            sources = []
-            
-            # Extract Grounding Sources
-            grounding_metadata = candidate.get('groundingMetadata')
-            if grounding_metadata and grounding_metadata.get('groundingAttributions'):
-                sources = [
-                    {
-                        "uri": attr['web']['uri'],
-                        "title": attr['web']['title']
-                    }
-                    for attr in grounding_metadata['groundingAttributions']
-                    if 'web' in attr and 'uri' in attr['web'] and 'title' in attr['web']
-                ]
-
-            return {"text": text, "sources": sources}
-
-        except requests.exceptions.RequestException as e:
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt
-                print(f"[{time.strftime('%H:%M:%S')}] Attempt {attempt + 1} failed: {e}. Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                return {"text": f"Error: Failed to connect to API after {MAX_RETRIES} attempts. {e}", "sources": []}
-        except Exception as e:
-             return {"text": f"An unexpected error occurred: {e}", "sources": []}
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def ask_one(question):
+        async with semaphore:
+            return await gemini_client.ask_async(question)
+
+    await gemini_client.open_async_session()
+    try:
+        return await asyncio.gather(*(ask_one(q) for q in questions))
+    finally:
+        await gemini_client.close_async_session()
+
+def run_batch_file(questions_file):
+    """Answers every non-empty line of a file (or stdin) and prints the results in order."""
+    questions = [line.strip() for line in questions_file if line.strip()]
+    print(f"\n[Thinking...] Sending {len(questions)} questions")
+    responses = asyncio.run(run_batch(questions))
+
+    for i, (question, response) in enumerate(zip(questions, responses)):
+        print("\n" + "=" * 50)
+        print(f"[Question {i+1}]: {question}")
+        print("[LLM Answer]")
+        print(response['answer'])
+        print("=" * 50)
+        print_sources(response['sources'])
+    print("-" * 50)
 
 def main():
+    parser = argparse.ArgumentParser(description="LLM-Powered Q&A CLI System")
+    parser.add_argument('--batch', metavar='FILE', type=argparse.FileType('r', encoding='utf-8'),
+                        help="answer every non-empty line of FILE ('-' for stdin) concurrently, then exit")
+    args = parser.parse_args()
+
     print("-" * 50)
     print("Welcome to the LLM-Powered Q&A CLI System")
-    print("Model: gemini-2.5-flash-preview-09-2025 (Google Search Grounding enabled)")
+    print(f"Model: {gemini_client.MODEL_NAME} (Google Search Grounding enabled)")
     print("-" * 50)
 
+    if args.batch:
+        with args.batch:
+            run_batch_file(args.batch)
+        return
+
     while True:
         try:
             raw_question = input("\nEnter your question (or type 'quit' to exit): \n> ")
@@ -101,19 +93,25 @@ def main():
             print(f"\n[Processed Question]: {processed_question}")
             print("\n[Thinking...]")
 
-            # 2. Get Answer from LLM
-            response = get_llm_answer(raw_question) # Send the raw question to the LLM for better context
-
-            # 3. Display Final Answer
+            # 2. Get Answer from LLM, printing it as it streams in
             print("\n" + "=" * 50)
             print("[LLM Answer]")
-            print(response['text'])
+            streamed = []
+
+            def show(text):
+                streamed.append(text)
+                print(text, end='', flush=True)
+
+            response = gemini_client.ask(raw_question, on_text=show) # Send the raw question to the LLM for better context
+
+            # 3. Finish the Answer (errors are never streamed, so print them here)
+            if streamed:
+                print()
+            if ''.join(streamed) != response['answer']:
+                print(response['answer'])
             print("=" * 50)
 
-            if response['sources']:
-                print("\n[Sources Used]:")
-                for i, source in enumerate(response['sources']):
-                    print(f"  {i+1}. {source['title']} ({source['uri']})")
+            print_sources(response['sources'])
             print("-" * 50)
 
         except KeyboardInterrupt:
@@ -1,93 +1,229 @@
+import asyncio
 import json
-import requests
-import os
+import hnswlib
+import numpy as np
+import orjson
+import sqlite3
+import threading
 import time
-from flask import Flask, render_template, request, jsonify
-
-# Flask App Initialization
-app = Flask(__name__)
+from sentence_transformers import SentenceTransformer
+from quart import Quart, Response, render_template, request
+
+import gemini_client
+
+# Quart App Initialization (async-capable Flask API, so /ask does not block a worker while waiting on Gemini)
+app = Quart(__name__)
+
+# Semantic cache: paraphrased questions ("capital of France?" vs "France's capital")
+# miss the exact cache, so each answered question is also embedded locally and
+# stored in an HNSW index. A new question whose nearest neighbour is within
+# SEMANTIC_MAX_DISTANCE (cosine similarity >= 0.92) reuses that answer.
+# Entries expire after gemini_client.CACHE_TTL, like the exact cache, since
+# grounded answers go stale.
+# The entries themselves live in a semantic_cache table in the exact cache's
+# SQLite file, so every gunicorn worker shares one store. Each worker keeps its
+# own in-memory HNSW index over that table (labels are row ids) and pulls in
+# rows added by other workers before each lookup; nothing is written at shutdown.
+# The table keeps at most SEMANTIC_MAX_ENTRIES recent rows. HNSW cannot free slots,
+# so once expired/purged entries fill the index it is rebuilt from the live rows.
+# If the database cannot be opened, SEMANTIC_DB is None and the semantic cache is off.
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+SEMANTIC_MAX_DISTANCE = 0.08
+SEMANTIC_MAX_ENTRIES = 5000
+SEMANTIC_PURGE_EVERY = 100  # inserts between deletions of expired and surplus rows
+EMBEDDER = None
+SEMANTIC_INDEX = None
+SEMANTIC_LOCK = threading.Lock()
+SEMANTIC_DB = gemini_client.open_cache_db(
+    'CREATE TABLE IF NOT EXISTS semantic_cache(id INTEGER PRIMARY KEY AUTOINCREMENT, question TEXT, vec BLOB, response BLOB, ts INTEGER)'
+)
+_semantic_last_id = 0  # highest row id already added to this worker's index
+
+def _log_semantic_error(e: Exception):
+    """Reports a semantic cache database failure; the lookup misses or the store is skipped."""
+    print(f"[{time.strftime('%H:%M:%S')}] Semantic cache database error: {e}")
+
+def _expiry_cutoff() -> int:
+    """Returns the oldest write time (epoch seconds) a semantic entry may have and still be served."""
+    return int(time.time()) - gemini_client.CACHE_TTL
+
+def _add_to_index(index, rows):
+    """Adds (id, vec) rows from the semantic_cache table to an HNSW index, labelled by row id."""
+    vectors = np.vstack([np.frombuffer(vec, dtype=np.float32) for _, vec in rows])
+    index.add_items(vectors, [row_id for row_id, _ in rows])
+
+def _rebuild_semantic_index():
+    """
+    Replaces this worker's index with a fresh one holding the newest unexpired rows,
+    dropping the slots of expired and purged entries. Caller holds SEMANTIC_LOCK.
+    """
+    global SEMANTIC_INDEX, _semantic_last_id
+    rows = SEMANTIC_DB.execute(
+        'SELECT id, vec FROM semantic_cache WHERE ts >= ? ORDER BY id DESC LIMIT ?',
+        (_expiry_cutoff(), SEMANTIC_MAX_ENTRIES),
+    ).fetchall()
+    # Room for as many new entries again before the next rebuild
+    index = hnswlib.Index(space='cosine', dim=EMBEDDING_DIM)
+    index.init_index(max_elements=2 * SEMANTIC_MAX_ENTRIES)
+    if rows:
+        _add_to_index(index, rows)
+        _semantic_last_id = max(_semantic_last_id, rows[0][0])
+    SEMANTIC_INDEX = index
+
+def _sync_semantic_index():
+    """Adds unexpired rows written since the last sync (by any worker) to this worker's index. Caller holds SEMANTIC_LOCK."""
+    global _semantic_last_id
+    if SEMANTIC_INDEX is None:
+        _rebuild_semantic_index()
+        return
+    rows = SEMANTIC_DB.execute(
+        'SELECT id, vec FROM semantic_cache WHERE id > ? AND ts >= ? ORDER BY id',
+        (_semantic_last_id, _expiry_cutoff()),
+    ).fetchall()
+    if not rows:
+        return
+
+    # Slots of deleted entries still count towards the fixed capacity
+    if SEMANTIC_INDEX.get_current_count() + len(rows) > SEMANTIC_INDEX.get_max_elements():
+        _rebuild_semantic_index()
+        return
+    _add_to_index(SEMANTIC_INDEX, rows)
+    _semantic_last_id = rows[-1][0]
+
+def _load_semantic_cache():
+    """Loads the embedding model and builds this worker's index from the unexpired shared entries."""
+    global EMBEDDER
+    EMBEDDER = SentenceTransformer(EMBEDDING_MODEL)
+    if SEMANTIC_DB is None:
+        return
+
+    with SEMANTIC_LOCK:
+        try:
+            _rebuild_semantic_index()
+        except sqlite3.Error as e:
+            _log_semantic_error(e)
 
-# --- LLM Configuration ---
-# NOTE: The Canvas environment provides this key during execution, but for local use, you would set it via environment variables.
-# We initialize it as an empty string, which the Canvas runtime will handle.
-API_KEY = os.environ.get("GEMINI_API_KEY", "")
-MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key={API_KEY}"
-MAX_RETRIES = 5
+def _embed(question: str):
+    """Returns the normalized sentence embedding for a question."""
+    return EMBEDDER.encode(question, normalize_embeddings=True)
 
-def get_llm_answer_api(prompt: str) -> dict:
+def _semantic_lookup(vector):
+    """
+    Returns the cached response of the most similar unexpired past question, or None.
+    Blocks on SQLite, so the event loop calls it in a worker thread.
+    """
+    if SEMANTIC_DB is None:
+        return None
+    with SEMANTIC_LOCK:
+        try:
+            _sync_semantic_index()
+            if SEMANTIC_INDEX.get_current_count() == 0:
+                return None
+            try:
+                labels, distances = SEMANTIC_INDEX.knn_query(vector, k=1)
+            except RuntimeError:
+                return None  # every entry has expired (been marked deleted)
+            if distances[0][0] >= SEMANTIC_MAX_DISTANCE:
+                return None
+
+            label = int(labels[0][0])
+            row = SEMANTIC_DB.execute(
+                'SELECT response FROM semantic_cache WHERE id = ? AND ts >= ?', (label, _expiry_cutoff())
+            ).fetchone()
+            if row is None:
+                SEMANTIC_INDEX.mark_deleted(label)  # expired or purged
+                return None
+            return orjson.loads(row[0])
+        except sqlite3.Error as e:
+            _log_semantic_error(e)
+            return None
+
+def _semantic_store(vector, question: str, response: dict):
     """
-    Handles the LLM API call logic for the web application.
+    Adds an answered question to the shared store and this worker's index.
+    Blocks on SQLite, so the event loop calls it in a worker thread.
     """
-    headers = {'Content-Type': 'application/json'}
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        # Enable Google Search grounding
-        "tools": [{"google_search": {}}],
-        "systemInstruction": {"parts": [{"text": "You are a helpful and expert Question-Answering system. Provide a concise, clear, and factual answer based on the query, citing sources if used."}]},
-    }
-
-    for attempt in range(MAX_RETRIES):
+    if SEMANTIC_DB is None:
+        return
+    with SEMANTIC_LOCK:
         try:
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()
-
-            result = response.json()
-            candidate = result.get('candidates', [None])[0]
-
-            if not candidate or not candidate.get('content') or not candidate['content'].get('parts'):
-                return {"answer": "Error: API response was empty or malformed.", "sources": []}
-
-            text = candidate['content']['parts'][0]['text']
-            sources = []
-            
-            # Extract Grounding Sources
-            grounding_metadata = candidate.get('groundingMetadata')
-            if grounding_metadata and grounding_metadata.get('groundingAttributions'):
-                sources = [
-                    {
-                        "uri": attr['web']['uri'],
-                        "title": attr['web']['title']
-                    }
-                    for attr in grounding_metadata['groundingAttributions']
-                    if 'web' in attr and 'uri' in attr['web'] and 'title' in attr['web']
-                ]
-
-            return {"answer": text, "sources": sources}
-
-        except requests.exceptions.RequestException as e:
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt
-                print(f"Attempt {attempt + 1} failed: {e}. Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-            else:
-                return {"answer": f"API Error: Failed to connect to LLM after {MAX_RETRIES} attempts. {e}", "sources": []}
-        except Exception as e:
-             return {"answer": f"An unexpected error occurred: {e}", "sources": []}
+            with SEMANTIC_DB:
+                row_id = SEMANTIC_DB.execute(
+                    'INSERT INTO semantic_cache(question, vec, response, ts) VALUES (?, ?, ?, ?)',
+                    (question, np.asarray(vector, dtype=np.float32).tobytes(), orjson.dumps(response), int(time.time())),
+                ).lastrowid
+                if row_id % SEMANTIC_PURGE_EVERY == 0:
+                    # Drop expired rows and everything beyond the newest SEMANTIC_MAX_ENTRIES
+                    SEMANTIC_DB.execute(
+                        'DELETE FROM semantic_cache WHERE ts < ? OR id <= ?',
+                        (_expiry_cutoff(), row_id - SEMANTIC_MAX_ENTRIES),
+                    )
+            _sync_semantic_index()
+        except sqlite3.Error as e:
+            _log_semantic_error(e)
+
+def json_response(payload, status: int = 200) -> Response:
+    """Builds a JSON response with orjson rather than jsonify's slower stdlib encoder."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
 
 
 # --- Routes ---
 
+@app.before_serving
+async def open_session():
+    """Creates the shared HTTP session once the server's event loop is running."""
+    await gemini_client.open_async_session()
+
+@app.before_serving
+async def load_semantic_cache():
+    """Loads the embedding model and builds the semantic index without blocking the event loop."""
+    await asyncio.to_thread(_load_semantic_cache)
+
+@app.after_serving
+async def close_session():
+    """Closes the shared HTTP session when the server shuts down."""
+    await gemini_client.close_async_session()
+
 @app.route('/')
-def index():
+async def index():
     """Renders the main HTML page."""
-    return render_template('index.html')
+    return await render_template('index.html')
 
 @app.route('/ask', methods=['POST'])
-def ask_llm():
+async def ask_llm():
     """Endpoint to handle question submission and call the LLM."""
-    data = request.json
+    data = await request.get_json()
     question = data.get('question', '').strip()
 
     if not question:
-        return jsonify({"answer": "Please provide a question.", "sources": []}), 400
+        return json_response({"answer": "Please provide a question.", "sources": []}, 400)
+
+    # Serve paraphrases of already-answered questions from the semantic cache
+    vector = await asyncio.to_thread(_embed, question)
+    cached = await asyncio.to_thread(_semantic_lookup, vector)
+    if cached is not None:
+        return json_response(cached)
 
     # Call the LLM API
-    response = get_llm_answer_api(question)
+    response = await gemini_client.ask_async(question)
+
+    # Only successful answers land in the exact cache; index exactly those
+    if gemini_client.is_cached(question):
+        await asyncio.to_thread(_semantic_store, vector, question, response)
+
+    return json_response(response)
 
-    return jsonify(response)
+@app.route('/cache/stats')
+async def cache_stats():
+    """Reports hit/miss counters and the current size of the response cache."""
+    return json_response(await asyncio.to_thread(gemini_client.cache_stats))
 
-# Required for Render deployment
+# Render deployment runs the app under gunicorn with async (uvicorn) workers, see Procfile:
+#   gunicorn app:app -k uvicorn_worker.UvicornWorker -w ${WEB_CONCURRENCY:-2}
+# Each worker's event loop keeps many /ask calls waiting on Gemini at once, so few
+# workers are needed. Every worker loads its own SentenceTransformer (torch) copy,
+# so keep WEB_CONCURRENCY low on small instances; the caches are shared via SQLite.
 if __name__ == '__main__':
-    # Running on localhost for testing
+    # Running on localhost for testing (single-process dev server)
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,382 @@
+import asyncio
+import hashlib
+import importlib.util
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import aiohttp
+import orjson
+import requests
+from cachetools import TLRUCache
+from requests.adapters import HTTPAdapter
+
+# --- Configuration ---
+# Shared by the CLI (LLM_QA_CLI.py) and the web app (app.py).
+# NOTE: The Canvas environment provides this key during execution, but for local use, you would set it via environment variables.
+# We initialize it as an empty string, which the Canvas runtime will handle.
+API_KEY = os.environ.get("GEMINI_API_KEY", "")
+MODEL_NAME = "gemini-2.5-flash-preview-09-2025"
+API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key={API_KEY}"
+# Server-sent events variant: the answer arrives in chunks as it is generated
+STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:streamGenerateContent?alt=sse&key={API_KEY}"
+MAX_RETRIES = 5
+MAX_BACKOFF = 30  # seconds; upper bound for the jittered retry delay
+SYSTEM_INSTRUCTION = "You are a helpful and expert Question-Answering system. Provide a concise, clear, and factual answer based on the query, citing sources if used."
+
+# Headers for both HTTP sessions. Grounded answers can be large, so ask for a
+# compressed body; brotli is only advertised when a decoder is installed,
+# since requests and aiohttp can only decode it then.
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept-Encoding': 'gzip, br' if importlib.util.find_spec('brotli') else 'gzip',
+    'Connection': 'keep-alive',
+}
+
+# Shared HTTP session so repeated questions reuse the same keep-alive
+# connection instead of redoing the TCP + TLS handshake on every call.
+SESSION = requests.Session()
+adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+SESSION.mount('https://', adapter)
+SESSION.headers.update(HEADERS)
+
+# Shared aiohttp session for async callers (created once the event loop is
+# running, see open_async_session). Its connector keeps a pool of keep-alive
+# connections to Gemini so concurrent users do not pay a fresh handshake each.
+ASYNC_SESSION = None
+
+# In-process exact-match response cache: repeated questions are answered from
+# memory instead of making another round-trip to Gemini.
+# Values are (expires_at, answer) so each entry expires at its own wall-clock time:
+# rows promoted from disk only live for the rest of their CACHE_TTL.
+CACHE_TTL = 3600  # seconds
+CACHE = TLRUCache(maxsize=1024, ttu=lambda _key, value, _now: value[0], timer=time.time)
+CACHE_LOCK = threading.Lock()
+CACHE_STATS = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+# Persistent second-level cache in SQLite, so answers survive restarts of the
+# CLI and the web workers. Memory misses fall back to it; expired rows are
+# purged at startup and every CACHE_PURGE_EVERY writes. DB access has its own
+# lock and a short busy timeout, and database errors only ever cost a cache miss.
+# The file defaults to this module's directory rather than the current one; if it
+# cannot be opened, DB is None and caching is memory-only.
+CACHE_DB_PATH = os.environ.get("LLM_CACHE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.db"))
+CACHE_PURGE_EVERY = 100
+DB_LOCK = threading.Lock()
+_db_writes = 0
+
+def _log_db_error(e: Exception):
+    """Reports a cache database failure; the cache simply misses or skips the write."""
+    print(f"[{time.strftime('%H:%M:%S')}] Cache database error: {e}")
+
+def open_cache_db(schema: str):
+    """
+    Opens a connection to the cache database and creates the table described by schema.
+    Returns None (after logging) if the database is unavailable, so callers can skip it.
+    """
+    try:
+        db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, timeout=1)
+    except sqlite3.Error as e:
+        _log_db_error(e)
+        return None
+    try:
+        db.execute('PRAGMA journal_mode=WAL')  # several gunicorn workers share the file
+    except sqlite3.Error as e:
+        _log_db_error(e)  # e.g. another worker is switching it at the same moment; WAL is persistent
+    try:
+        db.execute(schema)
+    except sqlite3.Error as e:
+        _log_db_error(e)
+        db.close()
+        return None
+    return db
+
+DB = open_cache_db('CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB, ts INTEGER)')
+
+# Request payload skeleton, built once. Only the question text changes per call,
+# so it is filled in under a lock and serialized straight to bytes.
+_PAYLOAD_TEMPLATE = {
+    "contents": [{"parts": [{"text": ""}]}],
+    # Use Google Search for up-to-date and factual grounding
+    "tools": [{"google_search": {}}],
+    "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+}
+_PAYLOAD_LOCK = threading.Lock()
+
+def _build_body(prompt: str) -> bytes:
+    """Serializes the request body for a prompt from the shared payload template."""
+    with _PAYLOAD_LOCK:
+        _PAYLOAD_TEMPLATE["contents"][0]["parts"][0]["text"] = prompt
+        return orjson.dumps(_PAYLOAD_TEMPLATE)
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizes a question for use as a cache key: lowercases it, collapses whitespace
+    and drops trailing ?!. so "What is Python?" and "what is  python" share an entry.
+    Inner punctuation is kept, so "C++" and "C#" stay distinct.
+    """
+    return ' '.join(question.lower().split()).rstrip('?!.').rstrip()
+
+def _cache_key(prompt: str) -> str:
+    """Builds the cache key for a question sent to the configured model."""
+    return hashlib.sha256(f"{MODEL_NAME}|{normalize_question(prompt)}".encode()).hexdigest()
+
+def _purge_expired_db():
+    """Deletes rows older than CACHE_TTL from the persistent cache. Caller holds DB_LOCK."""
+    with DB:
+        DB.execute('DELETE FROM cache WHERE ts < ?', (int(time.time()) - CACHE_TTL,))
+
+def _cache_get(key: str):
+    """
+    Returns the cached answer for a key (or None), updating the hit/miss counters.
+    Checks memory first, then the persistent cache (promoting fresh rows to memory).
+    May block on SQLite, so async callers run it in a worker thread.
+    """
+    with CACHE_LOCK:
+        entry = CACHE.get(key)
+        if entry is not None:
+            CACHE_STATS["hits"] += 1
+            return entry[1]
+
+    row = None
+    try:
+        with DB_LOCK:
+            if DB is not None:
+                row = DB.execute('SELECT v, ts FROM cache WHERE k = ?', (key,)).fetchone()
+    except sqlite3.Error as e:
+        _log_db_error(e)
+
+    with CACHE_LOCK:
+        if row is not None and row[1] + CACHE_TTL > time.time():
+            cached = orjson.loads(row[0])
+            CACHE[key] = (row[1] + CACHE_TTL, cached)
+            CACHE_STATS["disk_hits"] += 1
+            return cached
+        CACHE_STATS["misses"] += 1
+        return None
+
+def _cache_put(key: str, answer: dict):
+    """
+    Stores a successful answer in memory and in the persistent cache.
+    A failed database write is logged and otherwise ignored; it never loses the answer.
+    """
+    global _db_writes
+    now = time.time()
+    with CACHE_LOCK:
+        CACHE[key] = (now + CACHE_TTL, answer)
+
+    if DB is None:
+        return
+    try:
+        with DB_LOCK:
+            with DB:
+                DB.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, orjson.dumps(answer), int(now)))
+            _db_writes += 1
+            if _db_writes % CACHE_PURGE_EVERY == 0:
+                _purge_expired_db()
+    except sqlite3.Error as e:
+        _log_db_error(e)
+
+def is_cached(prompt: str) -> bool:
+    """Returns True if a successful answer for the prompt is currently cached in memory."""
+    with CACHE_LOCK:
+        return _cache_key(prompt) in CACHE
+
+def cache_stats() -> dict:
+    """Returns hit/miss counters and the current size of the response cache (disk_size is None without a database)."""
+    disk_size = None
+    try:
+        with DB_LOCK:
+            if DB is not None:
+                disk_size = DB.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+    except sqlite3.Error as e:
+        _log_db_error(e)
+    with CACHE_LOCK:
+        return dict(CACHE_STATS, size=len(CACHE), maxsize=CACHE.maxsize, disk_size=disk_size)
+
+if DB is not None:
+    try:
+        with DB_LOCK:
+            _purge_expired_db()
+    except sqlite3.Error as e:
+        _log_db_error(e)
+
+def _retry_wait(attempt: int, status, headers):
+    """
+    Returns how long to wait before the next attempt, or None if the error is not worth retrying.
+    Connection errors (no status), 429 and 5xx are retried: the server's Retry-After header is
+    honoured when present (clamped to MAX_BACKOFF), otherwise a full-jitter delay of up to min(MAX_BACKOFF, 2**attempt)
+    keeps simultaneous clients from retrying in lockstep. Other 4xx errors fail fast.
+    """
+    if status is not None and status != 429 and status < 500:
+        return None
+    retry_after = headers.get('Retry-After') if headers else None
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            wait = None  # HTTP-date form; fall back to jitter
+        if wait is not None and math.isfinite(wait):
+            return min(max(0.0, wait), MAX_BACKOFF)
+    return random.uniform(0, min(MAX_BACKOFF, 2 ** attempt))
+
+def _parse_result(result: dict):
+    """
+    Extracts the answer text and grounding sources from a Gemini response.
+    Returns None if the response was empty or malformed.
+    """
+    candidate = result.get('candidates', [None])[0]
+    if not candidate or not candidate.get('content') or not candidate['content'].get('parts'):
+        return None
+
+    text = candidate['content']['parts'][0]['text']
+    return {"answer": text, "sources": _extract_sources(candidate)}
+
+def _extract_sources(candidate: dict) -> list:
+    """Extracts the grounding sources (uri + title) from a response candidate."""
+    sources = []
+
+    # Extract Grounding Sources (one lookup of attr['web'] per attribution)
+    for attr in (candidate.get('groundingMetadata') or {}).get('groundingAttributions') or ():
+        web = attr.get('web')
+        if web and 'uri' in web and 'title' in web:
+            sources.append({"uri": web['uri'], "title": web['title']})
+
+    return sources
+
+def _read_stream(body: bytes, on_text):
+    """
+    Posts to the streaming endpoint and passes each text chunk to on_text as soon as it arrives.
+    Returns the assembled answer, or None if the stream contained no text.
+    """
+    chunks = []
+    sources = {}  # uri -> source; later chunks may repeat earlier attributions
+    with SESSION.post(STREAM_URL, data=body, timeout=30, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b'data: '):
+                continue
+            candidate = (orjson.loads(line[6:]).get('candidates') or [None])[0]
+            if not candidate:
+                continue
+            for part in candidate.get('content', {}).get('parts', ()):
+                text = part.get('text')
+                if text:
+                    chunks.append(text)
+                    on_text(text)
+            # Grounding metadata usually arrives with the final chunk
+            for source in _extract_sources(candidate):
+                sources.setdefault(source['uri'], source)
+
+    if not chunks:
+        return None
+    return {"answer": ''.join(chunks), "sources": list(sources.values())}
+
+def ask(prompt: str, on_text=None) -> dict:
+    """
+    Sends the prompt to the Gemini API with Google Search Grounding.
+    Implements exponential backoff for robustness.
+    Successful answers are cached, so repeated questions skip the API call.
+    If on_text is given, the answer is streamed and on_text is called with each
+    text chunk as it arrives (or once with the full answer on a cache hit).
+    The cache is keyed by normalize_question(prompt).
+    Returns {"answer": str, "sources": [{"uri", "title"}, ...]}.
+    """
+    key = _cache_key(prompt)
+    cached = _cache_get(key)
+    if cached is not None:
+        if on_text is not None:
+            on_text(cached['answer'])
+        return cached
+
+    body = _build_body(prompt)
+    streamed = []
+
+    def emit(text):
+        streamed.append(text)
+        on_text(text)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            if on_text is None:
+                response = SESSION.post(API_URL, data=body, timeout=30)
+                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+                answer = _parse_result(orjson.loads(response.content))
+            else:
+                answer = _read_stream(body, emit)
+            if answer is None:
+                return {"answer": "Error: API response was empty or malformed.", "sources": []}
+
+            _cache_put(key, answer)
+            return answer
+
+        except requests.exceptions.RequestException as e:
+            if streamed:
+                # Part of the answer was already shown; retrying would repeat it
+                return {"answer": f"API Error: The answer stream was interrupted. {e}", "sources": []}
+            failed = e.response
+            wait_time = _retry_wait(attempt, failed.status_code if failed is not None else None, failed.headers if failed is not None else None)
+            if wait_time is None:
+                return {"answer": f"API Error: The LLM API rejected the request. {e}", "sources": []}
+            if attempt < MAX_RETRIES - 1:
+                print(f"[{time.strftime('%H:%M:%S')}] Attempt {attempt + 1} failed: {e}. Retrying in {wait_time:.1f}s...")
+                time.sleep(wait_time)
+            else:
+                return {"answer": f"API Error: Failed to connect to LLM after {MAX_RETRIES} attempts. {e}", "sources": []}
+        except Exception as e:
+             return {"answer": f"An unexpected error occurred: {e}", "sources": []}
+
+async def open_async_session():
+    """Creates the shared aiohttp session; call once the event loop is running."""
+    global ASYNC_SESSION
+    ASYNC_SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers=HEADERS,
+    )
+
+async def close_async_session():
+    """Closes the shared aiohttp session."""
+    await ASYNC_SESSION.close()
+
+async def ask_async(prompt: str) -> dict:
+    """
+    Async version of ask() for event-loop callers, using the shared aiohttp session.
+    Shares the same cache, payload template and response parsing as ask().
+    Cache lookups and writes run in a worker thread so SQLite never blocks the event loop.
+    """
+    key = _cache_key(prompt)
+    cached = await asyncio.to_thread(_cache_get, key)
+    if cached is not None:
+        return cached
+
+    body = _build_body(prompt)
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with ASYNC_SESSION.post(API_URL, data=body) as response:
+                response.raise_for_status()
+                result = orjson.loads(await response.read())
+
+            answer = _parse_result(result)
+            if answer is None:
+                return {"answer": "Error: API response was empty or malformed.", "sources": []}
+
+            await asyncio.to_thread(_cache_put, key, answer)
+            return answer
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Only ClientResponseError (from raise_for_status) carries a status and headers
+            wait_time = _retry_wait(attempt, getattr(e, 'status', None), getattr(e, 'headers', None))
+            if wait_time is None:
+                return {"answer": f"API Error: The LLM API rejected the request. {e}", "sources": []}
+            if attempt < MAX_RETRIES - 1:
+                print(f"[{time.strftime('%H:%M:%S')}] Attempt {attempt + 1} failed: {e}. Retrying in {wait_time:.1f}s...")
+                await asyncio.sleep(wait_time)
+            else:
+                return {"answer": f"API Error: Failed to connect to LLM after {MAX_RETRIES} attempts. {e}", "sources": []}
+        except Exception as e:
+             return {"answer": f"An unexpected error occurred: {e}", "sources": []}
\ No newline at end of file